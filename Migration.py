@@ -14,21 +14,133 @@ import json
 import logging
 import os
 import sys
+import threading
 import time
 import traceback
 import urllib.parse
-from datetime import datetime
-from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 
+import orjson
 import pandas as pd
 import requests
 from pandas.tseries.offsets import BDay
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 
 import pymssql
 import ssl
 
+logger = logging.getLogger(__name__)
 
-def post_request(jira_rest_call, data, jira_authorization):
+
+class RateLimiter(object):
+    """
+    Purpose:
+        Token bucket which limits the amount of outbound calls per period so
+        parallel threads stay below the JIRA and Track-It! rate limits.
+    Args:
+        max_calls (int): Maximum amount of calls per period
+        period (float): Length of the period in seconds
+    """
+
+    def __init__(self, max_calls, period=1.0):
+        self.capacity = max_calls
+        self.rate = max_calls / period
+        self._tokens = max_calls
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Purpose:
+            Blocks until a call is allowed and consumes it.
+        Returns:
+            Nothing.
+        """
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self.rate)
+
+
+class RateLimitedSession(requests.Session):
+    """
+    Purpose:
+        requests Session which waits on a RateLimiter before every call.
+    Args:
+        rate_limiter (RateLimiter): Limiter shared by all calls of this session
+    """
+
+    def __init__(self, rate_limiter):
+        super(RateLimitedSession, self).__init__()
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        self.rate_limiter.acquire()
+        return super(RateLimitedSession, self).request(*args, **kwargs)
+
+
+class ThrottleRetry(Retry):
+    """
+    Purpose:
+        urllib3 Retry which also retries POST requests, but only when the server
+        answered 429. A throttled request has not been processed, so resending
+        it cannot create a duplicate JIRA issue. POSTs failing with 5xx are
+        still not retried.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code == 429 and self.total:
+            return True
+        return super(ThrottleRetry, self).is_retry(method, status_code, has_retry_after)
+
+
+def create_session(pool_maxsize=32, max_rate=10, retry_post=True):
+    """
+    Purpose:
+        Creates a requests Session which reuses a fixed pool of keep-alive
+        connections between calls, limits the call rate and retries with
+        exponential backoff (honouring Retry-After) on throttling (429) and,
+        for GET and PUT only, on transient server errors.
+    Args:
+        pool_maxsize (int): Maximum amount of pooled connections per host
+        max_rate (int): Maximum amount of calls per second
+        retry_post (bool): Whether throttled POSTs are retried. Must be False
+            for streamed bodies, which urllib3 cannot rewind to resend.
+    Returns:
+        A RateLimitedSession object.
+    """
+    retry_class = ThrottleRetry if retry_post else Retry
+    retry = retry_class(total=3, backoff_factor=0.3,
+                        status_forcelist=[429, 500, 502, 503, 504])
+    # pool_block makes threads wait for a pooled keep-alive connection instead of
+    # opening extra connections which are discarded once the pool is full
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize, pool_block=True, max_retries=retry)
+    session = RateLimitedSession(RateLimiter(max_rate))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# JIRA_SESSION carries the JIRA Authorization header, which is set on startup
+# from the config. Track-It! calls go through their own session so the JIRA
+# credentials are never sent to the Track-It! server. Attachment uploads use
+# JIRA_UPLOAD_SESSION, which does not retry POSTs since their streamed body
+# cannot be resent; post_file_request() retries them itself.
+JIRA_SESSION = create_session()
+JIRA_UPLOAD_SESSION = create_session(retry_post=False)
+TRACKIT_SESSION = create_session()
+
+
+def post_request(jira_rest_call, data):
     """
     Purpose:
         Submits POST request to create new ticket in JIRA and returns JSON
@@ -36,32 +148,28 @@ def post_request(jira_rest_call, data, jira_authorization):
         jira_rest_call (str): POST-able URL for JIRA
             Example: http://jira.org/rest/api/2/issue/
         data (str): JSON String in the format from get_database_cursor()
-        jira_authorization (str): BASE64 Encoded Username:Password
     Returns:
         String of POST Request response. Should be acknowledgement of success or failure.
     """
-    data = json.dumps(data).encode('utf8')
-    headers = {"Authorization": jira_authorization,
-               "Content-Type": "application/json"}
-    response = requests.post(jira_rest_call, headers=headers, data=data)
-    return response.json()
+    data = orjson.dumps(data)
+    headers = {"Content-Type": "application/json"}
+    response = JIRA_SESSION.post(jira_rest_call, headers=headers, data=data)
+    return orjson.loads(response.content)
 
 
-def get_request(jira_rest_call, jira_authorization):
+def get_request(jira_rest_call):
     """
     @TODO Deprecate this and create a generic JIRA REST call via Requests
     Purpose:
         Submits GET request to JIRA and returns JSON
     Args:
         jira_rest_call (str): GET-able URL for JIRA
-        jira_authorization (str): BASE64 Encoded Username:Password
     Returns:
         String of GET Request response. Should be in JSON format.
     """
-    headers = {"Authorization": jira_authorization,
-               "Content-Type": "application/json"}
-    response = requests.get(jira_rest_call, headers=headers)
-    return response.json()
+    headers = {"Content-Type": "application/json"}
+    response = JIRA_SESSION.get(jira_rest_call, headers=headers)
+    return orjson.loads(response.content)
 
 
 def create_trackit_key(trackit_api_username, track_it_full_hostname):
@@ -76,60 +184,248 @@ def create_trackit_key(trackit_api_username, track_it_full_hostname):
     """
     url = "http://" + track_it_full_hostname + \
         "/TrackitWebAPI/api/Login?username=" + trackit_api_username + "&pwd="
-    response = requests.get(url)
-    return response.json()["data"]["apiKey"]
+    response = TRACKIT_SESSION.get(url)
+    return orjson.loads(response.content)["data"]["apiKey"]
 
 
-def post_close_request_trackit(trackit_key, workorder_id, jira_link, track_it_full_hostname):
+class TrackItKey(object):
+    """
+    Purpose:
+        Caches the Track-It! authentication token from create_trackit_key() so
+        a batch of work orders logs in once instead of once per work order.
+        The token is refreshed after ttl seconds or when Track-It! answers 401.
+        Safe to share between the threads of run_parallel().
+    Args:
+        trackit_api_username (str): A Track-It! Technician ID
+        track_it_full_hostname (str): Track-It! Server Address/URL
+        ttl (int): Seconds before the token is requested again
+    """
+
+    def __init__(self, trackit_api_username, track_it_full_hostname, ttl=1800):
+        self.trackit_api_username = trackit_api_username
+        self.track_it_full_hostname = track_it_full_hostname
+        self.ttl = ttl
+        self._key = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Purpose:
+            Returns the cached token, logging in first if it is missing or expired.
+        Returns:
+            Some key String that is used to authenticate a Track-It! API POST
+        """
+        with self._lock:
+            if self._key is None or time.time() >= self._expires:
+                self._key = create_trackit_key(self.trackit_api_username,
+                                               self.track_it_full_hostname)
+                self._expires = time.time() + self.ttl
+            return self._key
+
+    def refresh(self, stale_key):
+        """
+        Purpose:
+            Discards a token rejected by Track-It! and returns a new one. Threads
+            which were rejected with the same stale token only log in once.
+        Args:
+            stale_key (str): The token which was rejected
+        Returns:
+            Some key String that is used to authenticate a Track-It! API POST
+        """
+        with self._lock:
+            if self._key == stale_key:
+                self._key = None
+        return self.get()
+
+
+def post_trackit_request(trackit_key, url, data):
+    """
+    Purpose:
+        Submits a POST request to the Track-It! API, logging in again once if
+        the cached token has been rejected.
+    Args:
+        trackit_key (TrackItKey): Cached Track-It! Authorization key
+        url (str): POST-able URL for Track-It!
+        data (bytes): JSON encoded body
+    Returns:
+        The requests Response object.
+    """
+    key = trackit_key.get()
+    header = {"TrackItAPIKey": key, "Content-Type": "text/json"}
+    response = TRACKIT_SESSION.post(url, headers=header, data=data)
+    if response.status_code == 401:
+        header["TrackItAPIKey"] = trackit_key.refresh(key)
+        response = TRACKIT_SESSION.post(url, headers=header, data=data)
+    return response
+
+
+def post_close_request_trackit(trackit_key, workorder_id, jira_link, trackit_rest_call):
     """
     Purpose:
         Submits POST request to close a Track-It! work order and sets
         the resolution as the link to the new JIRA ticket.
     Args:
-        trackit_key (str): Track-It! Authorization key from create_trackit_key()
+        trackit_key (TrackItKey): Cached Track-It! Authorization key
         workorder_id (int): Track-It! work order number
         jira_link (str): POST-able URL for JIRA
-        track_it_full_hostname (url): Track-It! Server Address/URL
+        trackit_rest_call (str): POST-able work order URL for Track-It!
+            Example: http://trackit.org/TrackitWebAPI/api/workorder/
     Returns:
         Nothing. A String of POST Request response should be logged
         to the file specified in the config.
         Example: 2017-08-10 09:58:29,566 - INFO - [Migration.py:64] - Work Order 52204 updated successfully
     """
-    url = "http://" + track_it_full_hostname + \
-        "/TrackitWebAPI/api/workorder/Close/" + str(workorder_id)
-    header = {"TrackItAPIKey": trackit_key, "Content-Type": "text/json"}
+    url = trackit_rest_call + "Close/" + str(workorder_id)
     text = "This workorder has been moved to \n" + str(jira_link) + ""
-    response = requests.post(url, headers=header, data=json.dumps(text))
-    if response.json()['success'] == 'false':
-        logging.warning(
-            "TrackIt workorder " + str(workorder_id) +
-            " failed to close because: " + response.json()['data']['Message'])
+    response = post_trackit_request(trackit_key, url, orjson.dumps(text))
+    response = orjson.loads(response.content)
+    if response['success'] == 'false':
+        logger.warning("TrackIt workorder %s failed to close because: %s",
+                       workorder_id, response['data']['Message'])
     else:
-        logging.info(response.json()['data']['message'])
+        logger.info(response['data']['message'])
 
 
-def post_addnote_request_trackit(trackit_key, workorder_id, jira_link, track_it_full_hostname):
+def post_addnote_request_trackit(trackit_key, workorder_id, jira_link, trackit_rest_call):
     """
     Purpose:
         Submits a POST request to add a note to the Track-It!
         work order with a link to the new JIRA ticket.
     Args:
-        trackit_key (str): Track-It! Authorization key from create_trackit_key()
+        trackit_key (TrackItKey): Cached Track-It! Authorization key
         workorder_id (int): Track-It! work order number
         jira_link (str): POST-able URL for JIRA
-        track_it_full_hostname (url): Track-It! Server Address/URL
+        trackit_rest_call (str): POST-able work order URL for Track-It!
     Returns:
         Nothing.
     """
-    url = "http://" + track_it_full_hostname + \
-        "/TrackitWebAPI/api/workorder/AddNote/" + str(workorder_id)
-    header = {"TrackItAPIKey": trackit_key, "Content-Type": "text/json"}
+    url = trackit_rest_call + "AddNote/" + str(workorder_id)
     text = "This workorder has been moved to \n" + str(jira_link) + ""
     data = {"IsPrivate": "false", "FullText": text, "ActivityCode": "Research"}
-    response = requests.post(url, headers=header, data=json.dumps(data))
+    response = post_trackit_request(trackit_key, url, orjson.dumps(data))
+
+
+# Used when no state file exists yet, reads every work order
+DEFAULT_MODIDATE = "1900-01-01 00:00:00"
 
 
-def get_database_cursor(db_connection, sql, jira_key):
+def load_last_modidate(state_file):
+    """
+    Purpose:
+        Reads the last_modidate of the previous run from the state file.
+    Args:
+        state_file (str): File path to the JSON state file
+    Returns:
+        The last_modidate String, or DEFAULT_MODIDATE if there is no readable
+        state file.
+    """
+    try:
+        with open(state_file) as json_data:
+            return json.load(json_data)["last_modidate"]
+    except FileNotFoundError:
+        return DEFAULT_MODIDATE
+    except (ValueError, KeyError, TypeError):
+        logger.warning("State file %s is corrupt, reading every work order: %s",
+                       state_file, sys.exc_info()[1])
+        return DEFAULT_MODIDATE
+
+
+def save_last_modidate(state_file, last_modidate):
+    """
+    Purpose:
+        Persists the last_modidate for the next run to the state file. It is
+        written to a temporary file first and then moved into place, so an
+        interrupted write never leaves a truncated state file behind.
+    Args:
+        state_file (str): File path to the JSON state file
+        last_modidate (str): Value returned by mainloop()
+    Returns:
+        Nothing.
+    """
+    temp_file = state_file + ".tmp"
+    with open(temp_file, 'w') as json_data:
+        json.dump({"last_modidate": last_modidate}, json_data)
+    os.replace(temp_file, state_file)
+
+
+def get_database_time(db_connection):
+    """
+    Purpose:
+        Retrieves the current time of the database server, so the
+        last_modidate is not affected by clock differences with this machine.
+    Args:
+        db_connection (pymssql Object): An open pymssql connection
+    Returns:
+        The database time String in the format YYYY-MM-DD HH:MM:SS.
+    """
+    cursor = db_connection.cursor()
+    cursor.execute("SELECT CONVERT(VARCHAR, GETDATE(), 120)")
+    return cursor.fetchall()[0][0]
+
+
+# Constant parts of the JSON body built in get_database_cursor()
+REPORTER = {"key": "api", "name": "api"}
+# Track-It! priority to JIRA issue type, anything else is an Incident Management
+ISSUETYPE_MAP = {"Project": "Project",
+                 "Ongoing Support": "Service Management"}
+CRQ_ISSUETYPE_MAP = dict(ISSUETYPE_MAP, **{"Change Request": "Change Request"})
+# Track-It! priorities which are not JIRA priorities
+PRIORITY_MAP = {"Ongoing Support": "Routine",
+                "Change Request": "Routine",
+                "Project": "Routine"}
+
+
+def sanitize(value):
+    """
+    Purpose:
+        Replaces spaces with underscores so the value is a valid JIRA label.
+    Args:
+        value (str): Track-It! field value, may be None
+    Returns:
+        The sanitized String, or the value unchanged if it is None or empty.
+    """
+    return value.replace(" ", "_") if value else value
+
+
+def fetch_rows(cursor, fetch_size):
+    """
+    Purpose:
+        Streams rows from an executed cursor in chunks so the full query
+        result is never held in memory at once.
+    Args:
+        cursor (pymssql Cursor): A cursor which has already executed a query
+        fetch_size (int): Amount of rows fetched from the server per round trip
+    Returns:
+        Generator of database rows.
+    """
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def batched(iterable, batch_size):
+    """
+    Purpose:
+        Groups an iterable into lists of at most batch_size items.
+    Args:
+        iterable (iterable): Any iterable, e.g. the get_database_cursor() generator
+        batch_size (int): Maximum amount of items per list
+    Returns:
+        Generator of lists.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def get_database_cursor(db_connection, sql, jira_key, fetch_size=200, params=None):
     """
     Purpose:
         Connects to a database and retrieves a SQL query result.
@@ -141,57 +437,30 @@ def get_database_cursor(db_connection, sql, jira_key):
             Server 2008.
         sql (str): A very specific SQL Select statement.
         jira_key (str): JIRA Project key
+        fetch_size (int): Amount of rows fetched from the database per round trip
+        params (dict): Optional query parameters, e.g. {"last_modidate": ...}
+            for a %(last_modidate)s placeholder in the SQL
     Returns:
-        Array of JSON-format dictionary objects ready for POSTing to JIRA issues.
+        Generator of JSON-format dictionary objects ready for POSTing to JIRA issues.
     """
     cursor = db_connection.cursor()
-    cursor.execute(sql)
-    database_full_output = []
-    jira_issuetype = ""
-
-    for row in cursor.fetchall():
-        row = list(row)
-
-        workorder_number = row[0]
-        priority = row[1]
-        request_date = row[2]
-        summary = row[3]
-        requester = row[4]
-        assignee_username = row[5]
-        due_date = row[6]
-        modify_date = row[7]
-        dept = row[8]
-        wo_type = row[9]
-        subtype = row[10]
-        category = row[11]
-        assigned_technician = row[12]
-        description = row[13]
-        notes = row[14]
-        company = row[15]
-
-        if priority == "Project":
-            jira_issuetype = "Project"
-        elif priority == "Ongoing Support":
-            jira_issuetype = "Service Management"
-        elif priority == "Change Request" and jira_key == "CRQ":
-            jira_issuetype = "Change Request"
-        else:
-            jira_issuetype = "Incident Management"
-
-        if subtype is not None:
-            if len(subtype) > 0:
-                subtype = subtype.replace(" ", "_")
-        if category is not None:
-            if len(category) > 0:
-                category = category.replace(" ", "_")
-        if company is not None:
-            if len(company) > 0:
-                company = company.replace(" ", "_")
-
-        if priority == "Ongoing Support" or priority == "Change Request" or priority == "Project":
-            priority = "Routine"
-        if category is None:
-            category = ""
+    if params:
+        cursor.execute(sql, params)
+    else:
+        cursor.execute(sql)
+    # Change Requests only exist as an issue type in the CRQ project
+    issuetype_map = CRQ_ISSUETYPE_MAP if jira_key == "CRQ" else ISSUETYPE_MAP
+    project = {"key": jira_key}
+
+    for (workorder_number, priority, request_date, summary, requester, assignee_username,
+         due_date, modify_date, dept, wo_type, subtype, category, assigned_technician,
+         description, notes, company) in fetch_rows(cursor, fetch_size):
+        jira_issuetype = issuetype_map.get(priority, "Incident Management")
+        priority = PRIORITY_MAP.get(priority, priority)
+        # Already done by REPLACE() in the SQL, kept for older config files
+        subtype = sanitize(subtype)
+        category = sanitize(category) or ""
+        company = sanitize(company)
         if dept is None:
             dept = ""
         if description is None:
@@ -199,9 +468,7 @@ def get_database_cursor(db_connection, sql, jira_key):
 
         json_body = {
             "fields": {
-                "project": {
-                    "key": jira_key
-                },
+                "project": project,
                 "summary": summary,
                 "description": description,
                 "customfield_10411": int(workorder_number),
@@ -228,70 +495,388 @@ def get_database_cursor(db_connection, sql, jira_key):
                     "key": assignee_username,
                     "name": assignee_username
                 },
-                "reporter": {
-                    "key": "api",
-                    "name": "api"
-                },
+                "reporter": REPORTER,
                 "priority": {
                     "name": priority
                 }
             }
         }
-        database_full_output.append(json_body)
-    return database_full_output
+        yield json_body
 
 
-def post_file_request(jira_rest_call, filepath, jira_authorization):
+def get_retry_after(response, default):
     """
     Purpose:
-        Submits a POST request to JIRA to upload a file to an issue.
+        Reads the seconds to wait from a throttled response's Retry-After header.
+    Args:
+        response (requests Response): A 429 response
+        default (float): Seconds to wait if the header is missing or an HTTP date
+    Returns:
+        Seconds to wait as a float.
+    """
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return default
+
+
+def post_file_request(jira_rest_call, filepath, max_attempts=4):
+    """
+    Purpose:
+        Submits a POST request to JIRA to upload a file to an issue. The
+        streamed body cannot be rewound by urllib3's Retry, so a throttled
+        (429) upload is retried here by reopening the file.
     Args:
         jira_rest_call (str): POST-able URL for a JIRA issue
         filepath (str): File path to a file (Less than 2GB)
-        jira_authorization (str): BASE64 Encoded Username:Password
+        max_attempts (int): Maximum amount of attempts when JIRA answers 429
     Returns:
         Returns a POST response from JIRA acknowledging whether if it
-        was a valid request.
+        was a valid request. Raises requests.HTTPError if the upload failed.
     """
-    headers = {"Authorization": jira_authorization,
-               "X-Atlassian-Token": "nocheck"}
-    files = {'file': open(filepath, 'rb')}
-    response = requests.post(jira_rest_call, headers=headers, files=files)
+    for attempt in range(max_attempts):
+        with open(filepath, 'rb') as file:
+            # Streams the file in chunks instead of reading it into memory
+            multipart = MultipartEncoder(
+                fields={'file': (os.path.basename(filepath), file, 'application/octet-stream')})
+            headers = {"X-Atlassian-Token": "nocheck",
+                       "Content-Type": multipart.content_type}
+            response = JIRA_UPLOAD_SESSION.post(jira_rest_call, headers=headers,
+                                                data=multipart)
+        if response.status_code != 429 or attempt == max_attempts - 1:
+            break
+        time.sleep(get_retry_after(response, 0.3 * 2 ** attempt))
+    response.raise_for_status()
     return response.text
 
 
-def import_attachments(trackit_id, jira_rest_call, jira_authorization, attachment_folder):
+def import_attachments(trackit_id, jira_rest_call, attachment_folder, upload_workers=4,
+                       skip_names=()):
     """
     Purpose:
-        Loops through a file directory and uploads it to a JIRA issue.
+        Uploads every file of a directory to a JIRA issue in parallel.
     Args:
         trackit_id (int): Work order number from Track-It!
         jira_rest_call (str): POST-able URL for a JIRA issue
-        jira_authorization (str): BASE64 Encoded Username:Password
         attachment_folder (str): Folder path to a specific work order's attachments
+        upload_workers (int): Maximum amount of concurrent uploads
+        skip_names (set): File names already attached to the JIRA issue
     Returns:
-        Dictionary of attachments that have been uploaded.
+        Dictionary of attachments that have been uploaded, or None if the
+        work order has no readable attachment folder. Raises the first failed upload.
     """
     trackit_dir = attachment_folder + '\\' + str(trackit_id)
-    if os.path.isdir(trackit_dir):
-        for file in os.listdir(trackit_dir):
-            filepath = trackit_dir + '\\' + str(file)
-            post_file_request(jira_rest_call, filepath, jira_authorization)
+    # Most work orders have no attachment folder, a single scandir call
+    # both checks for it and lists it
+    try:
+        with os.scandir(trackit_dir) as entries:
+            files = [entry for entry in entries
+                     if entry.is_file() and entry.name not in skip_names]
+    except FileNotFoundError:
+        return None
+    except OSError:
+        # Not a directory or not readable, treated as having no attachments
+        logger.warning("Skipping attachments of %s, cannot read %s: %s",
+                       trackit_id, trackit_dir, sys.exc_info()[1])
+        return None
+
+    if len(files) > 0:
+        # Kept low to avoid JIRA throttling, post_file_request() retries 429s.
+        # Any failed upload is raised so the Track-It! ticket is not closed;
+        # close_locked_workorder() uploads the missing files on the next run.
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            list(executor.map(lambda entry: post_file_request(jira_rest_call, entry.path),
+                              files))
+
+    return {trackit_id: [entry.name for entry in files]}
+
+
+def get_existing_trackit_ids(jira_rest_call_search, jira_key, trackit_ids, chunk_size=200):
+    """
+    Purpose:
+        Finds which Track-It! work order numbers already exist in a JIRA project
+        by searching only for the given IDs instead of scanning the whole project.
+    Args:
+        jira_rest_call_search (str): GET-able search URL for JIRA
+            Example: http://jira.org/rest/api/2/search
+        jira_key (str): JIRA Project key
+        trackit_ids (list): Track-It! work order numbers to look up
+        chunk_size (int): Maximum amount of IDs per JQL query to stay within URL limits
+    Returns:
+        Set of Track-It! work order numbers which already have a JIRA issue.
+    """
+    existing_ids = set()
+    for chunk in batched(trackit_ids, chunk_size):
+        jql = 'project="' + jira_key + '" AND cf[10411] in (' + \
+            ",".join(str(x) for x in chunk) + ")"
+        query = urllib.parse.urlencode({"jql": jql,
+                                        "fields": "customfield_10411",
+                                        "maxResults": 1000})
+        response = get_request(jira_rest_call_search + "?" + query)
+        existing_ids.update(int(issue["fields"]["customfield_10411"])
+                            for issue in response["issues"] if
+                            issue["fields"]["customfield_10411"] is not None)
+    return existing_ids
+
+
+def get_empty_duedate_issues(jira_rest_call_search, jira_key, max_workers, page_size=100):
+    """
+    Purpose:
+        Retrieves every Incident Management issue of a JIRA project without a
+        due date. The first page returns the total, the remaining pages are
+        then fetched in parallel.
+    Args:
+        jira_rest_call_search (str): GET-able search URL for JIRA
+        jira_key (str): JIRA Project key
+        max_workers (int): Maximum amount of pages fetched concurrently
+        page_size (int): Amount of issues per page (JIRA caps this server side)
+    Returns:
+        List of JIRA issue dictionaries with the priority, created and duedate fields.
+    """
+    jql = "project = " + jira_key + \
+        ' AND duedate is EMPTY AND type = "Incident Management"'
+
+    def get_page(start_at):
+        query = urllib.parse.urlencode({"jql": jql,
+                                        "fields": "priority,created,duedate",
+                                        "startAt": start_at,
+                                        "maxResults": page_size})
+        return get_request(jira_rest_call_search + "?" + query)
+
+    first_page = get_page(0)
+    issues = list(first_page["issues"])
+    # JIRA reports the page size it actually used, which may be capped server side
+    page_size = max(first_page.get("maxResults", page_size), 1)
+    start_ats = range(page_size, first_page["total"], page_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for page in executor.map(get_page, start_ats):
+            issues.extend(page["issues"])
+    return issues
+
+
+def get_workorder_number(data):
+    """
+    Purpose:
+        Returns the Track-It! work order number of a JSON body, which is logged
+        instead of the whole body.
+    Args:
+        data (dict): JSON body in the format from get_database_cursor()
+    Returns:
+        Track-It! work order number as an int.
+    """
+    return data["fields"]["customfield_10411"]
+
 
-        return {trackit_id: os.listdir(trackit_dir)}
+def migrate_workorder(data,
+                      trackit_key,
+                      jira_rest_call_post,
+                      trackit_rest_call,
+                      jira_browse_url,
+                      attachment_folder):
+    """
+    Purpose:
+        Migrates a single Track-It! work order to JIRA, uploads its attachments
+        and closes & comments on the old Track-It! ticket.
+    Args:
+        data (dict): JSON body in the format from get_database_cursor()
+        trackit_key (TrackItKey): Cached Track-It! Authorization key
+        jira_rest_call_post (str): POST-able URL for JIRA
+        trackit_rest_call (str): POST-able work order URL for Track-It!
+        jira_browse_url (str): URL prefix of JIRA issue links
+            Example: http://jira.org/browse/
+        attachment_folder (str): Folder path to a specific work order's attachments
+    Returns:
+        Nothing.
+    """
+    print("Moving workorders to Jira:" +
+          str(data["fields"]["customfield_10411"]))
+    logger.info("Moving workorders to Jira: %s", data["fields"]["customfield_10411"])
+
+    try:
+        response = (post_request(
+            jira_rest_call_post, data))
+    except (requests.RequestException, orjson.JSONDecodeError):
+        # replace customfield with data if you want the post request json string
+        logger.error("%s: %s", sys.exc_info()[1], data["fields"]["customfield_10411"])
+        return
+    # JIRA answers with errorMessages/errors instead of an issue when it rejects
+    # the body, skip the Track-It! close & comment for this work order only
+    if "key" not in response:
+        logger.error("JIRA rejected %s: %s", data["fields"]["customfield_10411"], response)
+        return
+
+    # Jira URL to newly created ticket
+    jira_link = jira_browse_url + str(response["key"])
+    jira_attachment_link = jira_rest_call_post + str(response["key"]) + "/attachments"
+    print(jira_attachment_link)
+    logger.info("Successfully migrated to Jira at: %s", jira_attachment_link)
+    import_attachments(data["fields"]["customfield_10411"],
+                       jira_attachment_link, attachment_folder)
+
+    post_addnote_request_trackit(trackit_key,
+                                 data["fields"]["customfield_10411"], jira_link,
+                                 trackit_rest_call)
+    post_close_request_trackit(trackit_key, data["fields"]["customfield_10411"], jira_link,
+                               trackit_rest_call)
+
+
+def close_locked_workorder(keys,
+                           trackit_key,
+                           trackit_rest_call,
+                           jira_rest_call_search,
+                           jira_browse_url,
+                           jira_rest_call_post,
+                           attachment_folder):
+    """
+    Purpose:
+        Attempts to close a Track-It! work order that already exists in JIRA
+        but was previously unable to be closed. Attachments missing on the
+        JIRA issue, e.g. after a failed upload, are uploaded first.
+    Args:
+        keys (int): Track-It! work order number
+        trackit_key (TrackItKey): Cached Track-It! Authorization key
+        trackit_rest_call (str): POST-able work order URL for Track-It!
+        jira_rest_call_search (str): GET-able search URL for JIRA
+        jira_browse_url (str): URL prefix of JIRA issue links
+        jira_rest_call_post (str): POST-able URL for JIRA
+        attachment_folder (str): Folder path to a specific work order's attachments
+    Returns:
+        Nothing.
+    """
+    jira_trackit_id_url = jira_rest_call_search + "?jql=%22TrackIT%20%23%22%3D" + \
+        str(keys) + "&fields=attachment"
+    issue = get_request(jira_trackit_id_url)["issues"][0]
+    jira_link = jira_browse_url + issue["key"]
+
+    attached = {attachment["filename"] for attachment in
+                issue["fields"].get("attachment") or []}
+    import_attachments(keys, jira_rest_call_post + issue["key"] + "/attachments",
+                       attachment_folder, skip_names=attached)
+
+    post_addnote_request_trackit(
+        trackit_key, keys, jira_link, trackit_rest_call)
+    post_close_request_trackit(
+        trackit_key, keys, jira_link, trackit_rest_call)
+
+
+def compute_duedates(issues, duedate_map):
+    """
+    Purpose:
+        Calculates due dates for JIRA issues by adding the business days mapped
+        to their priority onto their creation date, one vectorized pandas
+        operation per priority instead of one BDay addition per issue.
+    Args:
+        issues (list): JIRA issue dictionaries from get_empty_duedate_issues()
+        duedate_map (str): Dictionary of {Issue Priority:Resolution Days}
+    Returns:
+        List of (JIRA issue key, due date String) tuples.
+    """
+    if len(issues) == 0:
+        return []
+    df = pd.DataFrame([[ticket["key"], ticket["fields"]["priority"]["name"],
+                        ticket["fields"]["created"][0:10]] for ticket in issues],
+                      columns=["key", "priority", "created"])
+    df["created"] = pd.to_datetime(df["created"])
+
+    duedates = []
+    for priority, group in df.groupby("priority"):
+        if priority not in duedate_map:
+            logger.warning("No due date mapping for priority %s, skipping: %s",
+                           priority, list(group["key"]))
+            continue
+        group_duedates = (group["created"] + BDay(duedate_map[priority])).dt.strftime("%Y-%m-%d")
+        duedates.extend(zip(group["key"], group_duedates))
+    return duedates
+
+
+def update_duedate(value, jira_rest_call_post):
+    """
+    Purpose:
+        Submits a PUT request to set the due date of a JIRA issue.
+    Args:
+        value (tuple): (JIRA issue key, due date String) from compute_duedates()
+        jira_rest_call_post (str): URL for JIRA issues
+            Example: http://jira.org/rest/api/2/issue/
+    Returns:
+        Nothing. Raises requests.HTTPError if JIRA rejects the update, which is
+        logged per issue by run_parallel().
+    """
+    issue_key, duedate = value
+    headers = {"Content-Type": "application/json"}
+    response = JIRA_SESSION.put(jira_rest_call_post + str(issue_key), headers=headers,
+                                data=orjson.dumps({"fields": {"duedate": duedate}}))
+    response.raise_for_status()
+    logger.info("Due date of %s set to %s", issue_key, duedate)
+
+
+def submit_all(executor, function, items, *args):
+    """
+    Purpose:
+        Submits function(item, *args) for every item to a thread pool without
+        waiting for the results.
+    Args:
+        executor (ThreadPoolExecutor): Thread pool to submit to
+        function (callable): Function taking an item followed by *args
+        items (list): Items to fan out over the thread pool
+        *args: Extra positional arguments passed to function
+    Returns:
+        Dictionary of {Future:item} to pass to wait_all().
+    """
+    return {executor.submit(function, item, *args): item for item in items}
+
+
+def wait_all(function, futures, key=None):
+    """
+    Purpose:
+        Waits for futures from submit_all() and logs any exception per item so
+        one failure does not stall the batch.
+    Args:
+        function (callable): Function the futures were submitted with
+        futures (dict): Dictionary of {Future:item} from submit_all()
+        key (callable): Optional function returning what to log for an item,
+            e.g. get_workorder_number() so JSON bodies are not logged in full
+    Returns:
+        Nothing.
+    """
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception:
+            item = futures[future]
+            logger.exception("%s failed for %s", function.__name__,
+                             key(item) if key else item)
+
+
+def run_parallel(function, items, max_workers, *args):
+    """
+    Purpose:
+        Runs function(item, *args) for every item on a thread pool and logs
+        any exception per item so one failure does not stall the batch.
+    Args:
+        function (callable): Function taking an item followed by *args
+        items (list): Items to fan out over the thread pool
+        max_workers (int): Maximum amount of concurrent threads
+        *args: Extra positional arguments passed to function
+    Returns:
+        Nothing.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        wait_all(function, submit_all(executor, function, items, *args))
 
 
 def mainloop(trackit_api_username,
              jira_rest_call_post,
-             jira_rest_call_get_trackit_id,
-             jira_authorization,
+             jira_rest_call_search,
              db_connection,
              jira_key,
              track_it_full_hostname,
              jira_server_address,
              sql,
              attachment_folder,
-             duedate_map):
+             duedate_map,
+             max_workers=8,
+             batch_size=200,
+             last_modidate=DEFAULT_MODIDATE):
     """
     Purpose:
         The main function to run everything above. From retrieving Track-It!
@@ -300,140 +885,116 @@ def mainloop(trackit_api_username,
     Args:
         trackit_api_username (str): A Track-It! Technician ID
         jira_rest_call_post (str): POST-able URL for JIRA
-        jira_rest_call_get_trackit_id (str): GET-able URL for JIRA
-        jira_authorization (str): BASE64 Encoded Username:Password
+        jira_rest_call_search (str): GET-able search URL for JIRA
         db_connection (pymssql Object): A very specific library object from
             pymssql-2.1.3-cp36-cp36m-win_amd64.whl which can connect to SQL
             Server 2008.
         jira_key (str): JIRA Project key
         track_it_full_hostname (str): Track-It! Server Address/URL
         jira_server_address (str): JIRA Server Address/URL
-        sql (str): A very specific SQL Select statement.
+        sql (str): A very specific SQL Select statement. Wide text columns
+            should be CAST to a bounded VARCHAR and the result capped with TOP
+            so pymssql never buffers an unbounded result set. TOP caps the work
+            orders per run and should be at least batch_size, otherwise
+            batches are never full. Work orders beyond it are read next run.
         Example:
             use TRACKIT_DATA;
-            SELECT wo_num 'Workorder Number',
+            SELECT TOP (500) wo_num 'Workorder Number',
             priority 'Priority',
             LEFT(CONVERT(VARCHAR, REQDATE, 120), 10) AS 'Request Date',
-            task AS 'Summary',
+            CAST(task AS VARCHAR(255)) AS 'Summary',
             request 'Requestor',
             RESPONS AS 'Assignee Username',
             LEFT(CONVERT(VARCHAR, duedate, 120), 10) AS 'Due Date',
             LEFT(CONVERT(VARCHAR, modidate, 120), 10) AS 'Modify Date',
             TRACKIT_DATA.dbo.tasks.dept,
             type,
-            wotype2 'Subtype',
-            wotype3 'Category',
+            REPLACE(wotype2, ' ', '_') 'Subtype',
+            REPLACE(wotype3, ' ', '_') 'Category',
             respons 'Assigned Technician',
-            descript 'Description',
-            note 'Notes',
-            lookup1 'Company'
+            CAST(descript AS VARCHAR(4000)) 'Description',
+            CAST(note AS VARCHAR(4000)) 'Notes',
+            REPLACE(lookup1, ' ', '_') 'Company'
             FROM TRACKIT_DATA.dbo.tasks
             WHERE tasks.respons in ('Maxim Tam')
             and priority in ('Ongoing Support','High','Urgent','Critical','Routine','Project')
             and WorkOrderStatusId = 1
             and reqdate >= '2017-07-11'
+            and modidate >= %(last_modidate)s
             ORDER BY RESPONS, WO_NUM DESC;
         attachment_folder (str): Folder path to a specific work order's attachments
         duedate_map (str): Dictionary of {Issue Priority:Resolution Days}
+        max_workers (int): Maximum amount of work orders migrated concurrently
+        batch_size (int): Amount of work orders read from the database per batch
+        last_modidate (str): Only work orders modified since this time are read
+            if the SQL contains a %(last_modidate)s placeholder, e.g.
+            and modidate >= %(last_modidate)s
     Returns:
-        Nothing.
+        The last_modidate String to use for the next run.
     """
-    # Declare database query output
-    database_full_output = get_database_cursor(db_connection, sql, jira_key)
-    print(datetime.now().strftime("%Y-%m-%d %H:%M:%S") +
-          " Amount of open workorders: " + str(len(database_full_output)))
-    # Cleans query output to create list of new Trackit workorder IDs
-    # Retrieves all existing Jira Trackit IDs and compares the two lists
-    trackit_ids_trackit = [int(x["fields"]["customfield_10411"])
-                           for x in database_full_output]
-    trackit_ids_jira_dict = dict(
-        (get_request(jira_rest_call_get_trackit_id, jira_authorization)))
-    trackit_ids_jira = [int(issue["fields"]["customfield_10411"])
-                        for issue in trackit_ids_jira_dict["issues"] if
-                        str(issue["fields"]["customfield_10411"]) != 'None']
-    invalid_ids = [x for x in trackit_ids_trackit if x in trackit_ids_jira]
-    database_full_output_valid = [x for x in database_full_output if
-                                  int(x["fields"]["customfield_10411"]) not in invalid_ids]
-
-    # Submits POST request to JIRA to create new issue
-    # and closes & comments on the old Track-It! ticket
-    if len(database_full_output_valid) > 0:
-        for data in database_full_output_valid:
-
-            print("Moving workorders to Jira:" +
-                  str(data["fields"]["customfield_10411"]))
-            logging.info("Moving workorders to Jira:" +
-                         str(data["fields"]["customfield_10411"]))
-
-            trackit_key = create_trackit_key(
-                trackit_api_username, track_it_full_hostname=track_it_full_hostname)
-
-            try:
-                response = (post_request(
-                    jira_rest_call_post, data, jira_authorization))
-            except HTTPError:
-                # replace customfield with data if you want the post request json string
-                logging.error(
-                    str(sys.exc_info()[1]) + ": " + str(data["fields"]["customfield_10411"]))
-                continue
-
-            # Jira URL to newly created ticket
-            response = (response)
-            jira_link = "http://" + jira_server_address + \
-                "/browse/" + str(response["key"])
-            jira_attachment_link = "http://" + jira_server_address + r"/rest/api/2/issue/" + str(
-                response["key"]) + "/attachments"
-            print(jira_attachment_link)
-            logging.info("Successfully migrated to Jira at: " +
-                         jira_attachment_link)
-            import_attachments(data["fields"]["customfield_10411"],
-                               jira_attachment_link, jira_authorization, attachment_folder)
-
-            post_addnote_request_trackit(trackit_key,
-                                         data["fields"]["customfield_10411"], jira_link,
-                                         track_it_full_hostname)
-            post_close_request_trackit(trackit_key, data["fields"]["customfield_10411"], jira_link,
-                                       track_it_full_hostname)
+    # Logs in to Track-It! once for the whole run instead of once per work order
+    trackit_key = TrackItKey(trackit_api_username, track_it_full_hostname)
+    trackit_rest_call = "http://" + track_it_full_hostname + "/TrackitWebAPI/api/workorder/"
+    jira_browse_url = "http://" + jira_server_address + "/browse/"
+
+    # Streams the database query output in batches so migration can start
+    # while the rest of the rows are still being read. The next batch is read
+    # from the database and checked against Jira while the previous batch is
+    # still being migrated, with at most one batch in flight.
+    workorder_count = 0
+    invalid_ids = []
+    pending = {}
+    run_started = get_database_time(db_connection)
+    params = {"last_modidate": last_modidate} if "%(last_modidate)s" in sql else None
+    database_full_output = get_database_cursor(db_connection, sql, jira_key, batch_size, params)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for database_output in batched(database_full_output, batch_size):
+                workorder_count += len(database_output)
+                # Retrieves the batch's Trackit workorder IDs which already exist in Jira
+                # customfield_10411 is already cast to int in get_database_cursor()
+                trackit_ids_trackit = [x["fields"]["customfield_10411"] for x in database_output]
+                trackit_ids_jira = get_existing_trackit_ids(jira_rest_call_search, jira_key,
+                                                            trackit_ids_trackit)
+                invalid_ids.extend(x for x in trackit_ids_trackit if x in trackit_ids_jira)
+                database_output_valid = [x for x in database_output if
+                                         x["fields"]["customfield_10411"] not in trackit_ids_jira]
+
+                # Submits POST request to JIRA to create new issue
+                # and closes & comments on the old Track-It! ticket
+                wait_all(migrate_workorder, pending, get_workorder_number)
+                pending = submit_all(executor, migrate_workorder, database_output_valid,
+                                     trackit_key, jira_rest_call_post,
+                                     trackit_rest_call, jira_browse_url, attachment_folder)
+        finally:
+            # Also collects the batch in flight when reading the next batch fails,
+            # so its per-work-order errors are still logged
+            wait_all(migrate_workorder, pending, get_workorder_number)
+
+    print(time.strftime("%Y-%m-%d %H:%M:%S") +
+          " Amount of open workorders: " + str(workorder_count))
 
     # Attempts to close TrackIt tickets when previously unable to
     if len(invalid_ids) > 0:
         print("Updating previously locked workorders: " + str(invalid_ids))
-        for keys in invalid_ids:
-            trackit_key = create_trackit_key(
-                trackit_api_username, track_it_full_hostname)
-
-            jira_trackit_id_url = "http://" + jira_server_address + \
-                                  "/rest/api/2/search?jql=%22TrackIT%20%23%22%3D" + \
-                str(keys)
-            jira_link = "http://" + jira_server_address + "/browse/" \
-                        + get_request(jira_trackit_id_url,
-                                      jira_authorization)["issues"][0]["key"]
-
-            post_addnote_request_trackit(
-                trackit_key, keys, jira_link, track_it_full_hostname)
-            post_close_request_trackit(
-                trackit_key, keys, jira_link, track_it_full_hostname)
+        run_parallel(close_locked_workorder, invalid_ids, max_workers,
+                     trackit_key, trackit_rest_call,
+                     jira_rest_call_search, jira_browse_url,
+                     jira_rest_call_post, attachment_folder)
 
     # Due Date Creation
     # @TODO: PLEASE REFACTOR TO SHRINK MAINLOOP
-    get_empty_duedates_url = "http://" + jira_server_address + \
-        "/rest/api/2/search?jql=project%20%3D%20" \
-        "" + jira_key + "" \
-        "%20AND%20duedate%20is%20EMPTY%20AND%20type%20%20%3D%20%22Incident%20Management%22"
-
-    duedates_response = get_request(get_empty_duedates_url, jira_authorization)
-    srq_ids_empty = [[ticket["key"], ticket["fields"]["priority"]["name"],
-                      pd.to_datetime(ticket["fields"]["created"][0:10])]
-                     for ticket in duedates_response["issues"]]
+    duedate_issues = get_empty_duedate_issues(jira_rest_call_search, jira_key, max_workers)
+    srq_duedates = compute_duedates(duedate_issues, duedate_map)
 
-    for value in srq_ids_empty:
-        duedate = str(value[2] + BDay(duedate_map[str(value[1])]))[0:10]
-        headers = {"Authorization": "Basic YXBpOlBhc3N3b3Jk",
-                   "Content-Type": "application/json"}
+    run_parallel(update_duedate, srq_duedates, max_workers, jira_rest_call_post)
 
-        r = requests.put('http://' + config["jira_server_address"] + \
-                         '/rest/api/2/issue/' + str(value[0]),
-                         data=json.dumps({"fields": {"duedate": str(duedate)}}), headers=headers)
+    # Migrated work orders are closed and drop out of the query, so last_modidate
+    # only moves forward once a run finds no open work orders. Failed, locked or
+    # capped (SELECT TOP) work orders are therefore always read again.
+    if workorder_count > 0:
+        return last_modidate
+    return run_started
 
 
 if __name__ == "__main__":
@@ -444,41 +1005,65 @@ if __name__ == "__main__":
     jira_rest_call_post = "http://" + \
         config["jira_server_address"] + "/rest/api/2/issue/"
 
-    jira_rest_call_get_trackit_id = "http://" + config["jira_server_address"] + \
-        "/rest/api/2/search?jql=project%20%3D%20%22" + config["jira_fields"]["project"]["key"] + \
-        "%22&fields=customfield_10411&maxResults=1000"
+    jira_rest_call_search = "http://" + \
+        config["jira_server_address"] + "/rest/api/2/search"
 
+    # One state file per config so simultaneous scripts do not share it
+    state_file = config.get("state_file",
+                            os.path.splitext(sys.argv[1])[0] + "_state.json")
+
+    JIRA_SESSION.headers.update({"Authorization": config["jira_authorization"]})
+    JIRA_UPLOAD_SESSION.headers.update({"Authorization": config["jira_authorization"]})
+    # Each server gets its own limit of calls per second, shared by both JIRA sessions
+    JIRA_SESSION.rate_limiter = RateLimiter(config.get("max_rate", 10))
+    JIRA_UPLOAD_SESSION.rate_limiter = JIRA_SESSION.rate_limiter
+    TRACKIT_SESSION.rate_limiter = RateLimiter(config.get("max_rate", 10))
 
     logging.basicConfig(filename=config["log_file"], level=logging.DEBUG,
                         format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
 
+    last_modidate = load_last_modidate(state_file)
+
+    # The connection is kept open between runs and only recreated after an error
+    db_connection = None
     while True:
 
         try:
-            db_connection = pymssql.connect(
-                host=config["database_cnf"]["host"],
-                user=config["database_cnf"]["user"],
-                password=config["database_cnf"]["password"],
-                database=config["database_cnf"]["database"]
-            )
-
-            mainloop(trackit_api_username=config["trackit_api_username"],
-                     jira_rest_call_post=jira_rest_call_post,
-                     jira_rest_call_get_trackit_id=jira_rest_call_get_trackit_id,
-                     jira_authorization=config["jira_authorization"],
-                     db_connection=db_connection,
-                     jira_key=config["jira_fields"]["project"]["key"],
-                     track_it_full_hostname=config["trackIT_server_address"],
-                     jira_server_address=config["jira_server_address"],
-                     sql=config["sql"],
-                     attachment_folder=config["attachment_folder"],
-                     duedate_map=config["ticket_duetime_mapping_days"])
+            if db_connection is None:
+                db_connection = pymssql.connect(
+                    host=config["database_cnf"]["host"],
+                    user=config["database_cnf"]["user"],
+                    password=config["database_cnf"]["password"],
+                    database=config["database_cnf"]["database"]
+                )
+
+            last_modidate = mainloop(
+                trackit_api_username=config["trackit_api_username"],
+                jira_rest_call_post=jira_rest_call_post,
+                jira_rest_call_search=jira_rest_call_search,
+                db_connection=db_connection,
+                jira_key=config["jira_fields"]["project"]["key"],
+                track_it_full_hostname=config["trackIT_server_address"],
+                jira_server_address=config["jira_server_address"],
+                sql=config["sql"],
+                attachment_folder=config["attachment_folder"],
+                duedate_map=config["ticket_duetime_mapping_days"],
+                max_workers=config.get("max_workers", 8),
+                batch_size=config.get("batch_size", 200),
+                last_modidate=last_modidate)
+            save_last_modidate(state_file, last_modidate)
         except Exception as e:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             with open(config["traceback_file"], 'w') as traceback_file:
                 traceback.print_exception(
                     exc_type, exc_value, exc_traceback, limit=3, file=traceback_file)
-            logging.error(
-                "Unknown Error, see traceback file: " + str(sys.exc_info()))
+            logger.error("Unknown Error, see traceback file: %s", sys.exc_info())
+            # The error may have left the connection broken or mid-query
+            if db_connection is not None:
+                try:
+                    db_connection.close()
+                except pymssql.Error:
+                    pass
+                db_connection = None
 
         time.sleep(60)